@@ -1,18 +1,33 @@
-import json
+import asyncio
+import collections
+import functools
+import hashlib
 import uuid
 import azure.functions as func
 import logging
 import azure.durable_functions as df
-from openai import AzureOpenAI
 import os
-from azure.cognitiveservices.speech import (
-    SpeechConfig, 
-    SpeechSynthesizer, 
-    SpeechSynthesisOutputFormat, 
-    ResultReason,
-)
-from azure.cognitiveservices.speech.audio import AudioOutputConfig
 import base64
+import io
+import orjson
+import queue
+import random
+import re
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from typing import TYPE_CHECKING, Optional
+from tools import get_tool_definitions
+
+# SDKs only needed by activities are imported where they are used, so orchestrator
+# invocations on a cold worker don't pay for importing them. tiktoken is also needed by
+# the Messages entity to count tokens, so it is deferred only until the first entity operation.
+if TYPE_CHECKING:
+    import tiktoken
+    from azure.cognitiveservices.speech import SpeechConfig
+    from azure.storage.blob import ContainerClient
+    from cachetools import TTLCache
+    from openai import AsyncAzureOpenAI
 
 
 app = df.DFApp(http_auth_level=func.AuthLevel.FUNCTION)
@@ -24,9 +39,95 @@ OPEN_AI_ENDPOINT = os.environ.get("AZURE_OPENAI_ENDPOINT")
 OPEN_AI_API_VER = os.environ.get("AZURE_OPENAI_API_VERSION", "2024-12-01-preview")
 AZURE_OPENAI_DEPLOYMENT_NAME = os.environ.get("AZURE_OPENAI_DEPLOYMENT_NAME")
 
-speech_config = SpeechConfig(subscription=SPEECH_KEY, region=SPEECH_REGION)
-speech_config.speech_synthesis_output_format = SpeechSynthesisOutputFormat.Audio16Khz32KBitRateMonoMp3
-SYNTHESIZER = SpeechSynthesizer(speech_config=speech_config, audio_config=None)
+# Token budget for each model call. Tool schemas and room for the response are reserved
+# first, the leading system messages are always kept and the most recent messages
+# fill the remaining budget.
+MAX_TOKENS = int(os.environ.get("CHAT_MAX_TOKENS", "8000"))
+RESPONSE_TOKEN_RESERVE = int(os.environ.get("CHAT_RESPONSE_TOKEN_RESERVE", "1000"))
+# The page context is always kept in the chat window, so the HTML digest is capped to leave
+# room for the conversation
+HTML_DIGEST_MAX_TOKENS = int(os.environ.get("CHAT_HTML_MAX_TOKENS", str(MAX_TOKENS // 2)))
+# Hard cap on the number of non-system messages kept in a chat thread entity
+MAX_MESSAGES = int(os.environ.get("CHAT_MAX_MESSAGES", "50"))
+
+# Tab context is condensed before it is written into the system prompt. Screenshots are
+# uploaded to blob storage and only referenced by URL so the image stays out of the prompt.
+HTML_STRIP_TAGS = ("script", "style", "svg", "noscript")
+SCREENSHOT_MAX_SIZE = (1024, 1024)
+SCREENSHOT_JPEG_QUALITY = 60
+# Screenshots are private page content. Like cached speech they carry a createdAt metadata
+# field, and the container should have a storage lifecycle rule deleting blobs once their
+# URLs have expired, after SCREENSHOT_URL_EXPIRY_HOURS.
+SCREENSHOT_CONTAINER = os.environ.get("SCREENSHOT_CONTAINER", "screenshots")
+SCREENSHOT_URL_EXPIRY_HOURS = 24
+
+# Request body fields and their types each orchestrator needs, validated before an instance is started
+ORCHESTRATOR_REQUIRED_FIELDS = {
+    "agent_init_orchestrator": {"tabId": int, "html": str},
+    "agent_action_orchestrator": {"userPrompt": str, "chatThreadId": str},
+}
+
+# How long a status request waits for an orchestration to complete before returning 202
+STATUS_WAIT_MILLISECONDS = 2000
+STATUS_RETRY_INTERVAL_MILLISECONDS = 250
+
+# Tool schemas never change at runtime, so the request body fragment is built once
+TOOLS_REQUEST_BODY = {"tools": get_tool_definitions()}
+
+# Spoken when the model returns no content, with and without tool calls
+TOOL_CALL_FALLBACK_MESSAGE = "I'll help you with that action."
+CHAT_FALLBACK_MESSAGE = "I'm here to help you."
+
+# Tasks started by activities that may outlive the invocation, such as synthesizer pool warm up
+_background_tasks: "set[asyncio.Task]" = set()
+
+# Recent plain message responses per (chat thread, prompt) so repeated prompts skip the model.
+# Tool call responses are never cached since their actions have side effects in the browser.
+RESPONSE_CACHE_SIZE = 512
+RESPONSE_CACHE_TTL_SECONDS = 60
+
+# Chat client shared across activity invocations on this worker so connections are reused
+_client_lock = threading.Lock()
+_client: Optional["AsyncAzureOpenAI"] = None
+CHAT_MAX_KEEPALIVE_CONNECTIONS = 16
+CHAT_MAX_CONNECTIONS = 32
+CHAT_KEEPALIVE_EXPIRY_SECONDS = 90
+CHAT_TIMEOUT_SECONDS = 60.0
+CHAT_CONNECT_TIMEOUT_SECONDS = 5.0
+
+# Synthesized speech is cached by a hash of the voice settings and text, in memory and in
+# a blob container shared by all function instances. Cached blobs carry a createdAt
+# metadata field so they can be expired by a storage lifecycle rule.
+TTS_VOICE_NAME = "en-US-SaraNeural"
+TTS_RATE = "0.95"
+TTS_PITCH = "+5%"
+TTS_VOLUME = "+10%"
+TTS_STYLE = "friendly"
+TTS_CACHE_SIZE = 512
+TTS_CACHE_CONTAINER = os.environ.get("TTS_CACHE_CONTAINER", "tts-cache")
+TTS_CACHE_CONNECTION_STRING = os.environ.get("TTS_CACHE_CONNECTION_STRING") or os.environ.get("AzureWebJobsStorage")
+# Responses link to the cached blob with a short-lived SAS URL instead of embedding the audio
+TTS_AUDIO_URL_EXPIRY_MINUTES = 5
+# In-memory entries map a cache key to the encoded audio and whether the blob cache is
+# known to hold it
+_tts_cache: "collections.OrderedDict[str, tuple[str, bool]]" = collections.OrderedDict()
+_tts_cache_lock = threading.Lock()
+
+# Blob containers in the TTS cache storage account, set up on first use under their own lock
+# so cache lookups never wait on blob I/O. A failed setup is remembered and only retried
+# after a cool down.
+BLOB_CONTAINER_RETRY_SECONDS = 300
+_blob_containers_lock = threading.Lock()
+_blob_containers: "dict[str, ContainerClient]" = {}
+_blob_container_retry_at: "dict[str, float]" = {}
+
+# Synthesizers are pooled with their service connection opened ahead of time so requests
+# skip the websocket handshake. The pool is filled the first time an activity needs speech,
+# while the model responds. Each expires after a jittered lifetime so the pool doesn't
+# reconnect all at once.
+SYNTHESIZER_POOL_SIZE = 3
+SYNTHESIZER_MAX_AGE_SECONDS = 600
+SYNTHESIZER_MAX_AGE_JITTER_SECONDS = 60
 
 SYSTEM_MESSAGE = ( 
     "You are a helpful assistant that backs a browser extension. "
@@ -43,32 +144,392 @@ SYSTEM_MESSAGE = (
     "Your response should be natural and descriptive, helping the user understand what action "
     "you're taking on their behalf."
 )
+SYSTEM_PROMPT = {"role": "system", "content": SYSTEM_MESSAGE}
+
+@functools.lru_cache(maxsize=4)
+def get_tokenizer(model: str) -> "tiktoken.Encoding":
+    """
+    Get the tiktoken encoding for a model, loaded once per worker.
+    """
+    import tiktoken
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        # Deployment names do not always map to a model name
+        return tiktoken.get_encoding("cl100k_base")
+
+def _count_tokens(content, model: str = AZURE_OPENAI_DEPLOYMENT_NAME) -> int:
+    """
+    Count the tokens in a message's content with the model's tokenizer.
+    """
+    if not content:
+        return 0
+    if not isinstance(content, str):
+        content = orjson.dumps(content).decode()
+    return len(get_tokenizer(model or "").encode(content))
+
+def _truncate_tokens(text: str, max_tokens: int, model: str = AZURE_OPENAI_DEPLOYMENT_NAME) -> str:
+    """
+    Truncate text to at most max_tokens tokens of the model's tokenizer.
+    """
+    tokenizer = get_tokenizer(model or "")
+    tokens = tokenizer.encode(text)
+    if len(tokens) <= max_tokens:
+        return text
+    logging.info("Truncating text from %d to %d tokens", len(tokens), max_tokens)
+    return tokenizer.decode(tokens[:max_tokens])
+
+@functools.lru_cache(maxsize=1)
+def _tool_definition_tokens() -> int:
+    """
+    Tokens taken by the tool schemas sent with every model call, counted once per worker.
+    """
+    return _count_tokens(TOOLS_REQUEST_BODY["tools"])
+
+def _content_chars(messages: list) -> int:
+    """
+    Approximate size of a chat message list for logging without dumping its content.
+    """
+    return sum(len(str(m.get("content") or "")) for m in messages)
+
+def size_chat_window(messages: list) -> list:
+    """
+    Trim the chat window to fit within the token budget to keep token costs and utilization
+    below model limits. The leading system messages are always preserved, followed by the most recent
+    messages whose cumulative token count fits under MAX_TOKENS, after reserving room for
+    the tool schemas and the model's response. The latest message is always kept.
+    Cached token counts on the messages are used when present.
+    """
+    # TODO: Potentially condense dropped messages to reduce size using llm
+    head_length = next((i for i, m in enumerate(messages) if m.get("role") != "system"), len(messages))
+    if head_length == len(messages):
+        return [{k: v for k, v in m.items() if k != "token_count"} for m in messages]
+
+    head = messages[:head_length]
+    budget = MAX_TOKENS - RESPONSE_TOKEN_RESERVE - _tool_definition_tokens()
+    budget -= sum(m.get("token_count") or _count_tokens(m.get("content")) for m in head)
+
+    kept = []
+    for message in reversed(messages[head_length:]):
+        tokens = message.get("token_count") or _count_tokens(message.get("content"))
+        if kept and tokens > budget:
+            break
+        budget -= tokens
+        kept.append(message)
+
+    if len(kept) < len(messages) - head_length:
+        # Don't open the window on a reply whose user prompt was dropped
+        while len(kept) > 1 and kept[-1].get("role") != "user":
+            kept.pop()
+        logging.info("Trimmed chat window from %d to %d messages", len(messages), len(head) + len(kept))
+    # token_count is bookkeeping for the entity and is not accepted by the chat API
+    return [{k: v for k, v in m.items() if k != "token_count"} for m in head + kept[::-1]]
+
+def condense_html(html: str) -> str:
+    """
+    Condense page HTML for the model by removing scripts, styles, svgs and comments
+    and collapsing whitespace. Element attributes are kept so selectors still resolve.
+    The digest is truncated to HTML_DIGEST_MAX_TOKENS.
+    """
+    if not html:
+        return ""
+    from bs4 import BeautifulSoup, Comment
+    soup = BeautifulSoup(html, "html.parser")
+    for element in soup(HTML_STRIP_TAGS):
+        element.decompose()
+    for comment in soup.find_all(string=lambda text: isinstance(text, Comment)):
+        comment.extract()
+    return _truncate_tokens(re.sub(r"\s+", " ", str(soup)).strip(), HTML_DIGEST_MAX_TOKENS)
+
+def compress_screenshot(image_data: bytes) -> bytes:
+    """
+    Down-sample screenshot image data to a small JPEG.
+    """
+    from PIL import Image
+    # BytesIO over existing bytes shares them instead of copying
+    output = io.BytesIO()
+    with Image.open(io.BytesIO(image_data)) as image:
+        image.thumbnail(SCREENSHOT_MAX_SIZE, Image.LANCZOS)
+        image.convert("RGB").save(output, format="JPEG", quality=SCREENSHOT_JPEG_QUALITY)
+    return output.getvalue()
+
+def store_screenshot(screenshot_url: str) -> Optional[str]:
+    """
+    Compress a base64 image data URL screenshot and upload it to the screenshot container.
+    Returns a read-only URL to the uploaded JPEG, or None if it can't be stored or the
+    storage credential can't sign URLs.
+    Non data URLs are returned unchanged.
+    """
+    if not screenshot_url or not screenshot_url.startswith("data:image/"):
+        return screenshot_url
+    from azure.storage.blob import ContentSettings
+    container = _get_blob_container(SCREENSHOT_CONTAINER)
+    if container is None:
+        logging.warning("No blob storage configured, leaving the screenshot out of the chat context")
+        return None
+    _, encoded = screenshot_url.split(",", 1)
+    image_data = compress_screenshot(base64.b64decode(encoded))
+    # Content addressed so re-sent screenshots of an unchanged page are only stored once.
+    # Overwritten rather than skipped so createdAt, and the blob's age, follow the newest URL.
+    blob_name = hashlib.sha1(image_data).hexdigest() + ".jpg"
+    try:
+        container.upload_blob(
+            blob_name, image_data, overwrite=True,
+            content_settings=ContentSettings(content_type="image/jpeg"),
+            metadata={"createdAt": datetime.now(timezone.utc).isoformat()}
+        )
+    except Exception as e:
+        # The chat still works from the HTML alone, so a failed upload doesn't fail initialization
+        logging.warning("Error uploading screenshot, leaving it out of the chat context: %s", e)
+        return None
+    return _blob_read_url(container, blob_name, timedelta(hours=SCREENSHOT_URL_EXPIRY_HOURS))
+
+def _tts_cache_key(text: str) -> str:
+    """
+    Content address for synthesized speech of the given text with the current voice settings.
+    """
+    return hashlib.sha1(
+        f"{TTS_VOICE_NAME}|{TTS_RATE}|{TTS_PITCH}|{TTS_VOLUME}|{TTS_STYLE}|{text}".encode()
+    ).hexdigest()
+
+def _get_blob_container(name: str) -> Optional["ContainerClient"]:
+    """
+    Get a blob container in the TTS cache storage account, creating it on first use.
+    Returns None if no storage connection is configured or the container can't be set up.
+    """
+    container = _blob_containers.get(name)
+    if container is not None or not TTS_CACHE_CONNECTION_STRING:
+        return container
+    from azure.core.exceptions import ResourceExistsError
+    from azure.storage.blob import BlobServiceClient
+    with _blob_containers_lock:
+        container = _blob_containers.get(name)
+        if container is None and time.monotonic() >= _blob_container_retry_at.get(name, 0.0):
+            try:
+                container = BlobServiceClient.from_connection_string(TTS_CACHE_CONNECTION_STRING) \
+                    .get_container_client(name)
+                try:
+                    container.create_container()
+                except ResourceExistsError:
+                    pass
+                _blob_containers[name] = container
+            except Exception as e:
+                logging.warning("Error setting up blob container %s: %s", name, e)
+                _blob_container_retry_at[name] = time.monotonic() + BLOB_CONTAINER_RETRY_SECONDS
+                container = None
+    return container
+
+def _blob_read_url(container: "ContainerClient", blob_name: str, expiry: timedelta) -> Optional[str]:
+    """
+    Get a read-only SAS URL for a blob that expires after the given time.
+    Returns None if the container's credential can't sign URLs.
+    """
+    from azure.storage.blob import BlobSasPermissions, generate_blob_sas
+    account_key = getattr(container.credential, "account_key", None)
+    if not account_key:
+        return None
+    sas_token = generate_blob_sas(
+        account_name=container.account_name,
+        container_name=container.container_name,
+        blob_name=blob_name,
+        account_key=account_key,
+        permission=BlobSasPermissions(read=True),
+        expiry=datetime.now(timezone.utc) + expiry,
+    )
+    return f"{container.get_blob_client(blob_name).url}?{sas_token}"
+
+def _get_cached_speech(key: str) -> Optional[str]:
+    """
+    Look up synthesized speech in the in-memory cache, then the blob cache.
+    Returns a base64-encoded string of the audio data.
+    """
+    with _tts_cache_lock:
+        entry = _tts_cache.get(key)
+        if entry is not None:
+            _tts_cache.move_to_end(key)
+            return entry[0]
+    from azure.core.exceptions import ResourceNotFoundError
+    try:
+        container = _get_blob_container(TTS_CACHE_CONTAINER)
+        if container is None:
+            return None
+        audio_data = container.download_blob(key).readall()
+    except ResourceNotFoundError:
+        return None
+    except Exception as e:
+        logging.warning("Error reading speech cache: %s", e)
+        return None
+    return _cache_speech_in_memory(key, audio_data, in_blob=True)
+
+def _is_speech_cached_in_memory(text: str) -> bool:
+    """
+    Check whether speech for the given text is already in the in-memory cache.
+    """
+    with _tts_cache_lock:
+        return _tts_cache_key(text) in _tts_cache
+
+def _is_speech_in_blob(key: str) -> bool:
+    """
+    Check whether speech is known to be stored in the blob cache.
+    """
+    with _tts_cache_lock:
+        entry = _tts_cache.get(key)
+        return entry is not None and entry[1]
+
+def _cache_speech_in_memory(key: str, audio_data: bytes, in_blob: bool) -> str:
+    """
+    Store synthesized speech in the in-memory LRU, evicting the least recently used entry.
+    Audio is kept base64-encoded, the form it is returned in, so each clip is encoded once
+    instead of on every cache hit. Returns the encoded audio.
+    """
+    audio_b64 = base64.b64encode(audio_data).decode("ascii")
+    with _tts_cache_lock:
+        _tts_cache[key] = (audio_b64, in_blob)
+        _tts_cache.move_to_end(key)
+        if len(_tts_cache) > TTS_CACHE_SIZE:
+            _tts_cache.popitem(last=False)
+    return audio_b64
+
+def _cache_speech(key: str, audio_data: bytes) -> str:
+    """
+    Store synthesized speech in the in-memory cache and the blob cache.
+    Returns a base64-encoded string of the audio data.
+    """
+    from azure.core.exceptions import ResourceExistsError
+    from azure.storage.blob import ContentSettings
+    in_blob = False
+    try:
+        container = _get_blob_container(TTS_CACHE_CONTAINER)
+        if container is not None:
+            container.upload_blob(
+                key, audio_data, overwrite=False,
+                content_settings=ContentSettings(content_type="audio/mpeg"),
+                metadata={"createdAt": datetime.now(timezone.utc).isoformat()}
+            )
+            in_blob = True
+    except ResourceExistsError:
+        # Another instance cached the same speech first
+        in_blob = True
+    except Exception as e:
+        logging.warning("Error writing speech cache: %s", e)
+    return _cache_speech_in_memory(key, audio_data, in_blob)
+
+def _speech_audio_url(key: str) -> Optional[str]:
+    """
+    Get a short-lived read-only URL for cached speech in the blob cache.
+    Returns None unless the speech is known to be in the blob cache and its credential can
+    sign URLs, in which case the audio is returned inline instead.
+    """
+    if not _is_speech_in_blob(key):
+        return None
+    try:
+        container = _get_blob_container(TTS_CACHE_CONTAINER)
+        if container is None:
+            return None
+        return _blob_read_url(container, key, timedelta(minutes=TTS_AUDIO_URL_EXPIRY_MINUTES))
+    except Exception as e:
+        logging.warning("Error creating speech audio URL: %s", e)
+        return None
+
+@functools.lru_cache(maxsize=1)
+def _get_speech_config() -> "SpeechConfig":
+    """
+    Get the speech synthesis config, built once per worker.
+    """
+    from azure.cognitiveservices.speech import SpeechConfig, SpeechSynthesisOutputFormat
+    # The v2 endpoint supports both SSML requests and streaming text input
+    speech_config = SpeechConfig(
+        endpoint=f"wss://{SPEECH_REGION}.tts.speech.microsoft.com/cognitiveservices/websocket/v2",
+        subscription=SPEECH_KEY
+    )
+    speech_config.speech_synthesis_voice_name = TTS_VOICE_NAME
+    speech_config.speech_synthesis_output_format = SpeechSynthesisOutputFormat.Audio16Khz32KBitRateMonoMp3
+    return speech_config
+
+def _create_synthesizer() -> tuple:
+    """
+    Create a speech synthesizer with a pre-opened connection.
+    Returns the synthesizer, its connection and the time it expires at.
+    """
+    from azure.cognitiveservices.speech import Connection, SpeechSynthesizer
+    synthesizer = SpeechSynthesizer(speech_config=_get_speech_config(), audio_config=None)
+    connection = Connection.from_speech_synthesizer(synthesizer)
+    connection.open(True)
+    expires_at = time.monotonic() + SYNTHESIZER_MAX_AGE_SECONDS + random.uniform(
+        -SYNTHESIZER_MAX_AGE_JITTER_SECONDS, SYNTHESIZER_MAX_AGE_JITTER_SECONDS
+    )
+    return synthesizer, connection, expires_at
 
-def size_chat_window(messages: list):
+def _acquire_synthesizer() -> tuple:
     """
-    Calculate the size of the chat window based on the number of messages.
-    Resize the chat window if it exceeds a certain size to keep token costs and utilization below
-    model limits.
+    Take a synthesizer from the pool, creating one if every pooled synthesizer is in use.
     """
-    # TODO: Drop off oldest messages if the size exceeds a certain limit
-    # TODO: Potentially condense existing messages to reduce size using llm
+    try:
+        return _SYNTHESIZER_POOL.get_nowait()
+    except queue.Empty:
+        return _create_synthesizer()
 
-    return messages
+def _release_synthesizer(pooled: tuple, healthy: bool = True):
+    """
+    Return a synthesizer to the pool. Expired or failed synthesizers are replaced
+    with a freshly connected one. Never raises, so callers' own errors aren't masked.
+    """
+    _, connection, expires_at = pooled
+    if not healthy or time.monotonic() >= expires_at:
+        try:
+            connection.close()
+            pooled = _create_synthesizer()
+        except Exception as e:
+            # Leave the pool one short, acquiring creates a synthesizer when it is empty
+            logging.warning("Error replacing speech synthesizer: %s", e)
+            return
+    try:
+        _SYNTHESIZER_POOL.put_nowait(pooled)
+    except queue.Full:
+        pooled[1].close()
+
+def _warm_synthesizer_pool():
+    """
+    Fill the synthesizer pool with connected synthesizers, once per worker.
+    """
+    global _synthesizer_pool_warmed
+    with _synthesizer_pool_lock:
+        if _synthesizer_pool_warmed:
+            return
+        _synthesizer_pool_warmed = True
+    try:
+        while not _SYNTHESIZER_POOL.full():
+            _release_synthesizer(_create_synthesizer())
+    except Exception as e:
+        # Requests still connect their own synthesizer when the pool is empty
+        logging.warning("Error warming speech synthesizer pool: %s", e)
+
+_SYNTHESIZER_POOL: "queue.Queue[tuple]" = queue.Queue(maxsize=SYNTHESIZER_POOL_SIZE)
+_synthesizer_pool_lock = threading.Lock()
+_synthesizer_pool_warmed = False
 
 def text_to_speech(text: str) -> str:
     """
     Convert text to speech using Azure OpenAI's TTS capabilities.
     Returns a base64-encoded string of the audio data.
+    Identical text is served from the speech cache instead of being resynthesized.
     """
     try:
         if not text:
             logging.warning("No text provided for speech synthesis")
             return None
+
+        key = _tts_cache_key(text)
+        audio_b64 = _get_cached_speech(key)
+        if audio_b64 is not None:
+            logging.info("Speech synthesis served from cache")
+            return audio_b64
+
         ssml = f"""
         <speak version='1.0' xmlns='http://www.w3.org/2001/10/synthesis' xml:lang='en-US' xmlns:mstts='http://www.w3.org/2001/mstts'>
-            <voice name='en-US-SaraNeural'>
-                <mstts:express-as style="friendly" styledegree="2">
-                    <prosody rate='0.95' pitch='+5%' volume='+10%'>
+            <voice name='{TTS_VOICE_NAME}'>
+                <mstts:express-as style="{TTS_STYLE}" styledegree="2">
+                    <prosody rate='{TTS_RATE}' pitch='{TTS_PITCH}' volume='{TTS_VOLUME}'>
                         {text}
                     </prosody>
                 </mstts:express-as>
@@ -76,41 +537,215 @@ def text_to_speech(text: str) -> str:
         </speak>
         """
 
-        result = SYNTHESIZER.speak_ssml_async(ssml).get()
+        from azure.cognitiveservices.speech import ResultReason
+        pooled = _acquire_synthesizer()
+        healthy = False
+        try:
+            result = pooled[0].speak_ssml_async(ssml).get()
+            healthy = result.reason == ResultReason.SynthesizingAudioCompleted
+        finally:
+            # Failed synthesizers are replaced rather than returned to the pool
+            _release_synthesizer(pooled, healthy)
 
         if result.reason == ResultReason.SynthesizingAudioCompleted:
-            # Convert audio data to base64 string
             logging.info("Speech synthesis completed successfully")
-            return base64.b64encode(result.audio_data).decode('utf-8')
+            return _cache_speech(key, result.audio_data)
         else:
             raise Exception(f"Speech synthesis failed: {result.reason}")
     except Exception as e:
-        logging.error(f"Error occurred during text-to-speech synthesis: {e}")
+        logging.error("Error occurred during text-to-speech synthesis: %s", e)
         raise e
 
+class _SpeechStream:
+    """
+    Speech synthesis fed with text as it is generated, so synthesis overlaps the model's
+    streamed response. Text is written with write() and the audio is collected with finish().
+    """
+
+    def __init__(self):
+        from azure.cognitiveservices.speech import SpeechSynthesisRequest, SpeechSynthesisRequestInputType
+        self._text = []
+        self.finished = False
+        self._request = SpeechSynthesisRequest(input_type=SpeechSynthesisRequestInputType.TextStream)
+        self._request.rate = TTS_RATE
+        self._request.pitch = TTS_PITCH
+        self._request.volume = TTS_VOLUME
+        self._request.style = TTS_STYLE
+        self._pooled = _acquire_synthesizer()
+        try:
+            self._result_future = self._pooled[0].speak_async(self._request)
+        except Exception:
+            _release_synthesizer(self._pooled, healthy=False)
+            raise
+
+    def write(self, text: str):
+        self._text.append(text)
+        self._request.input_stream.write(text)
+
+    def finish(self) -> str:
+        """
+        Close the text input and wait for synthesis to complete.
+        Returns a base64-encoded string of the audio data.
+        """
+        from azure.cognitiveservices.speech import ResultReason
+        self._request.input_stream.close()
+        self.finished = True
+        healthy = False
+        try:
+            result = self._result_future.get()
+            healthy = result.reason == ResultReason.SynthesizingAudioCompleted
+        finally:
+            _release_synthesizer(self._pooled, healthy)
+        if not healthy:
+            raise Exception(f"Speech synthesis failed: {result.reason}")
+        logging.info("Streaming speech synthesis completed successfully")
+        return _cache_speech(_tts_cache_key("".join(self._text)), result.audio_data)
+
+    def cancel(self):
+        """
+        Abandon synthesis, replacing the synthesizer since it may still be mid request.
+        """
+        self._request.input_stream.close()
+        self.finished = True
+        _release_synthesizer(self._pooled, healthy=False)
+
+def _get_client() -> "AsyncAzureOpenAI":
+    """
+    Get the Azure OpenAI chat client, creating it on first use.
+    The SDK is imported here so workers that only run entities and orchestrators
+    don't pay for importing it on cold start.
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                import httpx
+                from openai import AsyncAzureOpenAI, DefaultAsyncHttpxClient
+                # Keep idle TLS connections to the endpoint open between chat calls
+                http_client = DefaultAsyncHttpxClient(
+                    limits=httpx.Limits(
+                        max_keepalive_connections=CHAT_MAX_KEEPALIVE_CONNECTIONS,
+                        max_connections=CHAT_MAX_CONNECTIONS,
+                        keepalive_expiry=CHAT_KEEPALIVE_EXPIRY_SECONDS,
+                    ),
+                    timeout=httpx.Timeout(CHAT_TIMEOUT_SECONDS, connect=CHAT_CONNECT_TIMEOUT_SECONDS),
+                )
+                _client = AsyncAzureOpenAI(
+                    api_key=OPEN_AI_API_KEY,
+                    azure_endpoint=OPEN_AI_ENDPOINT,
+                    api_version=OPEN_AI_API_VER,
+                    http_client=http_client,
+                )
+    return _client
+
+def _entity_messages(entity_value: dict) -> list:
+    """
+    Flatten the Messages entity state into the chat message list sent to the model.
+    """
+    system = [m for m in (entity_value.get("system"), entity_value.get("context")) if m]
+    return system + entity_value["history"]
+
+def _with_token_count(message: dict) -> dict:
+    """
+    Copy of a message with its token count cached, so shared messages like SYSTEM_PROMPT
+    are never mutated.
+    """
+    return {**message, "token_count": _count_tokens(message.get("content"))}
+
+def _append_message(entity_value: dict, message: dict):
+    """
+    Append a message to the Messages entity history, evicting the oldest messages
+    once MAX_MESSAGES is reached.
+    """
+    # Cache the token count so trimming the chat window doesn't re-tokenize history
+    message["token_count"] = _count_tokens(message.get("content"))
+    # Append in place so an add doesn't copy the whole history
+    history = entity_value["history"]
+    history.append(message)
+    if len(history) > MAX_MESSAGES:
+        del history[:len(history) - MAX_MESSAGES]
+
+def _op_get(context: df.DurableEntityContext, entity_value: dict) -> dict:
+    logging.info("Getting state of conversation entity: %s-%s", context.entity_name, context.entity_key)
+    context.set_result(_entity_messages(entity_value))
+    return entity_value
+
+def _op_add(context: df.DurableEntityContext, entity_value: dict) -> dict:
+    logging.info("Adding message to conversation entity: %s-%s\nMessage: %s", context.entity_name, context.entity_key, context.get_input())
+    _append_message(entity_value, context.get_input())
+    return entity_value
+
+def _op_append_and_get(context: df.DurableEntityContext, entity_value: dict) -> dict:
+    logging.info("Adding message to and getting state of conversation entity: %s-%s\nMessage: %s", context.entity_name, context.entity_key, context.get_input())
+    _append_message(entity_value, context.get_input())
+    context.set_result(_entity_messages(entity_value))
+    return entity_value
+
+def _op_clear(context: df.DurableEntityContext, entity_value: dict) -> dict:
+    logging.info("Clearing conversation entity: %s-%s", context.entity_name, context.entity_key)
+    # Keep the system prompt and page context so the assistant persona and page survive a reset
+    entity_value["system"] = entity_value.get("system") or _with_token_count(SYSTEM_PROMPT)
+    entity_value["history"].clear()
+    return entity_value
+
+def _op_set(context: df.DurableEntityContext, entity_value: dict) -> dict:
+    logging.info("Setting state of conversation entity: %s-%s", context.entity_name, context.entity_key)
+    # The state includes the page context, so it is only dumped at debug level
+    logging.debug("State: %s", context.get_input())
+    return _messages_state(context.get_input() or [])
+
+def _messages_state(messages: list) -> dict:
+    """
+    Build the Messages entity state from a chat message list.
+    """
+    # Leading system messages are the static prompt and then the page context
+    system_count = 0
+    while system_count < min(2, len(messages)) and messages[system_count].get("role") == "system":
+        system_count += 1
+    # Count tokens once here so trimming the chat window doesn't re-tokenize the system
+    # messages, which it always includes, on every turn
+    messages = [_with_token_count(m) for m in messages]
+    system = messages[:system_count] + [None] * (2 - system_count)
+    return {
+        "system": system[0],
+        "context": system[1],
+        "history": list(collections.deque(messages[system_count:], maxlen=MAX_MESSAGES))
+    }
+
+# Messages entity operations by name. Each takes the entity context and current state
+# and returns the new state.
+_OPS = {
+    "get": _op_get,
+    "add": _op_add,
+    "append_and_get": _op_append_and_get,
+    "clear": _op_clear,
+    "set": _op_set,
+}
+
 @app.entity_trigger(context_name="context")
 def Messages(context: df.DurableEntityContext):
-    logging.info(f"Chat messages state for entry: {context.entity_key}")
-    # Default to an empty list if no state exists
-    # This allows the entity to be created without any initial messages
-    entity_value = context.get_state(lambda: [])
+    logging.info("Chat messages state for entry: %s", context.entity_key)
+    # State is {"system", "context", "history"} once the init orchestrator has set it
+    entity_value = context.get_state(lambda: None)
+    # Threads created before the state was split into system, context and history hold
+    # the plain message list. Convert them, treating an empty (cleared) list as missing.
+    if isinstance(entity_value, list):
+        entity_value = _messages_state(entity_value) if entity_value else None
 
     operation = context.operation_name
-    if operation == "get":
-        logging.info(f"Getting state of conversation entity: {context.entity_name}-{context.entity_key}")
-        context.set_result(entity_value)
-    elif operation == "add":
-        logging.info(f"Adding message to conversation entity: {context.entity_name}-{context.entity_key}\nMessage: {context.get_input()}")
-        entity_value.append(context.get_input())
-    elif operation == "clear":
-        logging.info(f"Clearing conversation entity: {context.entity_name}-{context.entity_key}")
-        entity_value = []
-    elif operation == "set":
-        logging.info(f"Setting state of conversation entity: {context.entity_name}-{context.entity_key}\nState: {context.get_input()}")
-        entity_value = context.get_input()
-    else:
-        logging.warning(f"Unknown operation: {operation} on entity: {context.entity_name}-{context.entity_key}")
-    context.set_state(entity_value)     
+    handler = _OPS.get(operation)
+    if not handler:
+        logging.warning("Unknown operation: %s on entity: %s-%s", operation, context.entity_name, context.entity_key)
+        return
+    # Only set creates a chat thread. Other operations on a thread that was never initialized
+    # return None without creating state, so unknown thread IDs are reported as missing
+    if entity_value is None and operation != "set":
+        logging.warning("Operation %s on uninitialized entity: %s-%s", operation, context.entity_name, context.entity_key)
+        context.set_result(None)
+        # Setting a result marks the entity as existing, so undo that
+        context.destruct_on_exit()
+        return
+    context.set_state(handler(context, entity_value))
 
 @app.route(route="orchestrators/{functionName}")
 @app.durable_client_input(client_name="client")
@@ -123,35 +758,60 @@ async def http_start(req: func.HttpRequest, client: df.DurableOrchestrationClien
             status_code=400
         )
     
-    request_body = req.get_json()
-    if not request_body:
+    try:
+        request_body = orjson.loads(req.get_body())
+    except orjson.JSONDecodeError:
+        request_body = None
+    if not request_body or not isinstance(request_body, dict):
         return func.HttpResponse(
             "Please pass a valid JSON body.",
             status_code=400
         )
+
+    # Reject unknown orchestrators and malformed requests before paying for an orchestration instance
+    required_fields = ORCHESTRATOR_REQUIRED_FIELDS.get(function_name)
+    if required_fields is None:
+        return func.HttpResponse(
+            f"Unknown orchestrator function: {function_name}",
+            status_code=400
+        )
+    missing_keys = [key for key in required_fields if request_body.get(key) in (None, "")]
+    if missing_keys:
+        return func.HttpResponse(
+            f"Missing required fields for {function_name}: {', '.join(missing_keys)}",
+            status_code=400
+        )
+    invalid_keys = [key for key, field_type in required_fields.items() if not isinstance(request_body[key], field_type)]
+    if invalid_keys:
+        return func.HttpResponse(
+            f"Invalid field types for {function_name}: {', '.join(invalid_keys)}",
+            status_code=400
+        )
     
     instance_id = await client.start_new(function_name, None, request_body)
-    
-    try:
-        result = await client.wait_for_completion_or_create_check_status_response(
-            req, instance_id, timeout_in_milliseconds=60000
-        )
 
-        # If is an HTTP response, return it directly
-        if isinstance(result, func.HttpResponse):
-            return result
-        
-        # Otherwise, return the result as a JSON response
-        return func.HttpResponse(
-            json.dumps(result),
-            status_code=200,
-            mimetype="application/json"
+    # Return 202 with the status endpoints right away rather than holding the request
+    # open until the orchestration completes. Clients poll orchestrators/status/{instanceId}.
+    return client.create_check_status_response(req, instance_id)
+
+
+@app.route(route="orchestrators/status/{instanceId}")
+@app.durable_client_input(client_name="client")
+async def http_status(req: func.HttpRequest, client: df.DurableOrchestrationClient) -> func.HttpResponse:
+    instance_id = req.route_params.get('instanceId')
+    try:
+        # Wait briefly for completion so polling clients get the result as soon as it is ready.
+        # Returns the orchestration output, or 202 with the status endpoints if still running.
+        return await client.wait_for_completion_or_create_check_status_response(
+            req, instance_id,
+            timeout_in_milliseconds=STATUS_WAIT_MILLISECONDS,
+            retry_interval_in_milliseconds=STATUS_RETRY_INTERVAL_MILLISECONDS
         )
 
     except Exception as e:
-        logging.error(f"Error waiting for orchestrator: {e}")
+        logging.error("Error waiting for orchestrator: %s", e)
         return func.HttpResponse(
-            json.dumps({
+            orjson.dumps({
                 "status": "error",
                 "message": "An error occurred while waiting for the orchestrator.",
                 "error": str(e)
@@ -165,37 +825,55 @@ async def http_start(req: func.HttpRequest, client: df.DurableOrchestrationClien
 def agent_init_orchestrator(context: df.DurableOrchestrationContext):
     logging.info("Starting agent initialization orchestrator")
     
-    # Process html and screenshot context
-    result = yield context.call_activity("process_chat_context", context.get_input())
+    tab_context = context.get_input()
+    tab_id = tab_context.get("tabId")
+    # The extension sends the screenshot as screenshotUrl
+    screenshot_url = tab_context.get("screenshotUrl") or tab_context.get("screenshot")
+
+    # Condense html and compress the screenshot in parallel
+    html_result, screenshot_result = yield context.task_all([
+        context.call_activity("condense_html_activity", tab_context.get("html")),
+        context.call_activity("compress_screenshot_activity", screenshot_url)
+    ])
 
-    if not result or result.get("status") != "success" or result.get("chatThreadId") is None:
-        logging.error(f"Agent initialization failed: {result}")
+    if not html_result or html_result.get("status") != "success":
+        logging.error("Agent initialization failed for tab %s: %s", tab_id, html_result)
         return {
             "status": "error",
             "message": "Failed to initialize chat thread",
             "chatThreadId": None,
-            "error": result.get("error", "Unknown error")
+            "error": (html_result or {}).get("error", "Unknown error")
         }
+    # The chat still works from the HTML alone, so a screenshot that can't be processed
+    # is left out rather than failing initialization
+    if not screenshot_result or screenshot_result.get("status") != "success":
+        logging.warning("Continuing without screenshot for tab %s: %s", tab_id, screenshot_result)
+        screenshot_result = {}
     
-    # Initialize chat thread entity
-    chat_thread_id = result.get("chatThreadId")
+    # Initialize chat thread entity. Orchestrators must be deterministic, so the id
+    # comes from the replay-safe uuid generator
+    chat_thread_id = uuid.UUID(context.new_uuid()).hex
     entity_id = df.EntityId("Messages", chat_thread_id)
 
     # Initialize the chat thread with system message, screenshot, and html content if given
-    messages = [{"role": "system", "content": SYSTEM_MESSAGE}]
-    messages[0]["content"] += f"\n\nHTML Content: {result.get('content', '')}"
-    messages[0]["content"] += f"\n\nScreenshot URL: {result.get('screenshot', '')}"
+    # in a single entity operation.
+    # The static prompt is its own message ahead of the page context so the model side prompt
+    # prefix cache matches it byte for byte across threads
+    page_context = f"HTML Content: {html_result.get('html_digest', '')}"
+    screenshot_ref = screenshot_result.get("screenshot_ref")
+    if screenshot_ref:
+        page_context += f"\n\nScreenshot URL: {screenshot_ref}"
+    messages = [SYSTEM_PROMPT, {"role": "system", "content": page_context}]
     
-    updated_messages = yield context.call_entity(entity_id, "set", messages)
+    yield context.call_entity(entity_id, "set", messages)
 
-    logging.info(f"Orchestrator completed with result: {result}")
     response =  {
         "status": "success",
         "message": "Chat initialization executed successfully",
         "chatThreadId": chat_thread_id,
         "error": None
     }
-    logging.info(f"Agent initialization orchestrator completed with response: {response}")
+    logging.info("Agent initialization orchestrator completed with response: %s", response)
     return response
 
 
@@ -221,14 +899,17 @@ def agent_action_orchestrator(context: df.DurableOrchestrationContext):
             "message": "Missing user prompt or chat thread ID",
             "error": "Invalid request parameters"
         }
-    logging.info(f"Getting agent action for prompt: {user_prompt} and chat thread: {chat_thread_id}")
+    logging.info("Getting agent action for prompt: %s and chat thread: %s", user_prompt, chat_thread_id)
     # Add user message to the chat thread entity
     new_message = {"role": "user", "content": user_prompt}
 
     entity_id = df.EntityId("Messages", chat_thread_id)
-    current_messages = yield context.call_entity(entity_id, "get")
-    logging.info(f"Current messages in chat thread: {current_messages}")
-    # If the entity does not exist or has no messages besides the system message, return error status
+    # Add the new user message and get the updated chat thread in a single entity operation
+    current_messages = yield context.call_entity(entity_id, "append_and_get", new_message)
+    if isinstance(current_messages, list):
+        logging.info("Current messages in chat thread: %d msgs, ~%d chars", len(current_messages), _content_chars(current_messages))
+    logging.debug("Current messages in chat thread: %s", current_messages)
+    # The entity returns None for a chat thread that was never initialized, so return error status
     if not current_messages or not isinstance(current_messages, list) or len(current_messages) < 1:
         logging.error("Chat thread does not exist or has been cleared")
         return {
@@ -236,22 +917,16 @@ def agent_action_orchestrator(context: df.DurableOrchestrationContext):
             "message": "Failed to retrieve messages from chat thread",
             "error": "Invalid messages retrieved from chat history"
         }
-    # Add the new user message to the chat thread
-    yield context.call_entity(entity_id, "add", new_message)
-    current_messages.append(new_message)
-    if not current_messages or not isinstance(current_messages, list):
-        logging.error("Failed to retrieve messages from entity")
-        return {
-            "status": "error",
-            "message": "Failed to retrieve messages from chat thread",
-            "error": "Invalid messages retrieved from chat history"
-        }
     
     # Call the activity function with chat messages
-    result = yield context.call_activity("get_action_activity", current_messages)
+    result = yield context.call_activity("get_action_activity", {
+        "chatThreadId": chat_thread_id,
+        "userPrompt": user_prompt,
+        "messages": current_messages
+    })
 
     if not result or result.get("status") != "success":
-        logging.error(f"Get agent action failed: {result}")
+        logging.error("Get agent action failed: %s", result)
         return {
             "status": "error",
             "message": "Failed to get agent action",
@@ -265,14 +940,15 @@ def agent_action_orchestrator(context: df.DurableOrchestrationContext):
     #     assistant_message["tool_calls"] = []
     #     tool_call_ids = []
     #     for action in result.get("actions", []):
-    #         tool_call_id = f"call_{uuid.uuid4().hex[:8]}"
+    #         # Replay-safe, unlike a per-process counter or uuid4
+    #         tool_call_id = f"call_{uuid.UUID(context.new_uuid()).hex[:8]}"
     #         tool_call_ids.append(tool_call_id)
     #         assistant_message["tool_calls"].append({
     #             "id": tool_call_id,  # Generate a simple call ID
     #             "type": "function",
     #             "function": {
     #                 "name": action["action"],
-    #                 "arguments": json.dumps(action["arguments"])
+    #                 "arguments": orjson.dumps(action["arguments"]).decode()
     #             }
     #         })
     #     # Add the assistant message with tool calls
@@ -291,73 +967,152 @@ def agent_action_orchestrator(context: df.DurableOrchestrationContext):
     # else:
     #     # Add the assistant message without tool calls
     #     yield context.call_entity(entity_id, "add", assistant_message)
-    yield context.call_entity(entity_id, "add", assistant_message)
-    logging.info(f"Added assistant message to chat thread: {assistant_message}")
+    # The orchestrator doesn't need a reply, so signal the entity instead of waiting on a call
+    context.signal_entity(entity_id, "add", assistant_message)
+    logging.info("Added assistant message to chat thread: %s", assistant_message)
     return result
 
 
-@app.activity_trigger(input_name="messages")
-def get_action_activity(messages: list):
+def _start_background_task(coroutine) -> asyncio.Task:
+    """
+    Start a task that may outlive the activity invocation that started it. The event loop
+    only keeps weak references to tasks, so they are held here until they finish.
+    """
+    task = asyncio.create_task(coroutine)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+@functools.lru_cache(maxsize=1)
+def _get_response_cache() -> "TTLCache":
+    """
+    Get the response cache, created on first use.
+    """
+    from cachetools import TTLCache
+    return TTLCache(maxsize=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL_SECONDS)
+
+def _response_cache_key(chat_thread_id: str, user_prompt: str) -> tuple:
+    """
+    Key a response by chat thread and a digest of the user's prompt.
+    """
+    return (chat_thread_id, hashlib.blake2b(user_prompt.encode(), digest_size=16).digest())
+
+@app.activity_trigger(input_name="action_request")
+async def get_action_activity(action_request: dict):
     logging.info("Starting get action activity")
+    messages = action_request.get("messages", [])
+    speech = None
+    speculative_tts = None
     try:
-        from tools import get_tool_definitions
-        tool_definitions = get_tool_definitions()
-        with AzureOpenAI(api_key=OPEN_AI_API_KEY, azure_endpoint=OPEN_AI_ENDPOINT, api_version=OPEN_AI_API_VER) as chat_client:
-            logging.info(f"Chat messages received: {messages}")
-            # Call model with messages and tool definitions
-            response = chat_client.chat.completions.create(
-                model=AZURE_OPENAI_DEPLOYMENT_NAME,
-                messages=messages,
-                tools=tool_definitions,
-                tool_choice="auto",
-            )
-            message = response.choices[0].message
-            chat_response = message.content
-            logging.info(f"Model response: {chat_response}")
+        cache_key = _response_cache_key(action_request.get("chatThreadId", ""), action_request.get("userPrompt", ""))
+        cached_response = _get_response_cache().get(cache_key)
+        if cached_response is not None:
+            logging.info("Returning cached response for repeated prompt")
+            return cached_response
+        chat_client = _get_client()
+        logging.info("Chat messages received: %d msgs, ~%d chars", len(messages), _content_chars(messages))
+        logging.debug("Chat messages received: %s", messages)
+        messages = size_chat_window(messages)
+        # Connect the synthesizer pool while the model responds the first time this worker
+        # needs speech
+        if not _synthesizer_pool_warmed:
+            _start_background_task(asyncio.to_thread(_warm_synthesizer_pool))
+        # Tool call only responses have no content to stream, so synthesize their fallback
+        # message while the model responds. A speculation that goes unused still warms the cache.
+        if not _is_speech_cached_in_memory(TOOL_CALL_FALLBACK_MESSAGE):
+            speculative_tts = _start_background_task(asyncio.to_thread(text_to_speech, TOOL_CALL_FALLBACK_MESSAGE))
+            speculative_tts.add_done_callback(lambda task: task.cancelled() or task.exception())
+        # Stream the model response with tool definitions so speech synthesis can start
+        # on the first words instead of waiting for the full completion
+        response = await chat_client.chat.completions.create(
+            model=AZURE_OPENAI_DEPLOYMENT_NAME,
+            messages=messages,
+            # Tools are sent as a fixed request body extension so the SDK doesn't
+            # re-validate and transform the static schemas on every call
+            extra_body=TOOLS_REQUEST_BODY,
+            tool_choice="auto",
+            stream=True,
+        )
+        content_parts = []
+        tool_calls = {}
+        async for chunk in response:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta
+            if delta.content:
+                if speech is None:
+                    # Acquiring a synthesizer may connect a new one when the pool is empty,
+                    # which blocks, so it is done off the event loop
+                    speech = await asyncio.to_thread(_SpeechStream)
+                speech.write(delta.content)
+                content_parts.append(delta.content)
+            # Tool calls arrive as fragments keyed by their index in the response
+            for tool_call in delta.tool_calls or []:
+                call = tool_calls.setdefault(tool_call.index, {"name": "", "arguments": ""})
+                if tool_call.function and tool_call.function.name:
+                    call["name"] += tool_call.function.name
+                if tool_call.function and tool_call.function.arguments:
+                    call["arguments"] += tool_call.function.arguments
+        chat_response = "".join(content_parts)
+        logging.info("Model response: %s", chat_response)
 
-             # Ensure we always have content for speech synthesis and user feedback
-            if not chat_response and message.tool_calls:
+        if speech is not None:
+            # Speech synthesis blocks, so wait for it off the event loop
+            audio_data_b64 = await asyncio.to_thread(speech.finish)
+        else:
+            # Ensure we always have content for speech synthesis and user feedback.
+            # Fallbacks are fixed phrases, so their speech is normally served from cache.
+            if tool_calls:
                 # Provide a default message when OpenAI returns None content but has tool calls
-                chat_response = "I'll help you with that action."
-            elif not chat_response:
+                chat_response = TOOL_CALL_FALLBACK_MESSAGE
+            else:
                 # Fallback for any other case where content is None
-                chat_response = "I'm here to help you."
-
-            # Get text to speech for model response
-            audio_data_b64 = text_to_speech(chat_response)
-
-            if message.tool_calls:
-                tool_calls_info = []
-                for tool_call in message.tool_calls:
-                    action = tool_call.function.name
-                    args = json.loads(tool_call.function.arguments)
-
-                    logging.info(f"Tool call detected: {action} with args: {args}")
-                    tool_calls_info.append({
-                        "action": action,
-                        "arguments": args
-                    })
-                return {
-                    "status": "success",
-                    "response_type": "tool_calls",
-                    "chat_message": chat_response,
-                    "chat_audio": audio_data_b64,
-                    "actions": tool_calls_info,
-                    "error": None
-                }
+                chat_response = CHAT_FALLBACK_MESSAGE
+            if tool_calls and speculative_tts is not None:
+                audio_data_b64 = await speculative_tts
             else:
-                logging.info("No tool calls detected in the response")
-                return {
-                    "status": "success",
-                    "response_type": "message",
-                    "chat_message": chat_response,
-                    "chat_audio": audio_data_b64,
-                    "actions": [],
-                    "error": None
-                }
+                audio_data_b64 = await asyncio.to_thread(text_to_speech, chat_response)
+
+        # Link to the cached blob rather than inlining the audio, which keeps it out of the
+        # orchestration history. The speech cache key is derived from the spoken text.
+        audio_url = await asyncio.to_thread(_speech_audio_url, _tts_cache_key(chat_response))
+        if audio_url is not None:
+            audio_data_b64 = None
+
+        if tool_calls:
+            tool_calls_info = [
+                {"action": call["name"], "arguments": orjson.loads(call["arguments"] or "{}")}
+                for _, call in sorted(tool_calls.items())
+            ]
+            logging.info("Tool calls detected: %s", tool_calls_info)
+            return {
+                "status": "success",
+                "response_type": "tool_calls",
+                "chat_message": chat_response,
+                "chat_audio": audio_data_b64,
+                "chat_audio_url": audio_url,
+                "actions": tool_calls_info,
+                "error": None
+            }
+        else:
+            logging.info("No tool calls detected in the response")
+            result = {
+                "status": "success",
+                "response_type": "message",
+                "chat_message": chat_response,
+                "chat_audio": audio_data_b64,
+                "chat_audio_url": audio_url,
+                "actions": [],
+                "error": None
+            }
+            _get_response_cache()[cache_key] = result
+            return result
 
     except Exception as e:
-        logging.error(f"Error in get_action_activity: {e}")
+        logging.error("Error in get_action_activity: %s", e)
+        if speech is not None and not speech.finished:
+            # Cancelling replaces the synthesizer with a newly connected one
+            await asyncio.to_thread(speech.cancel)
         return {
             "status": "error",
             "chat_message": "Im sorry an error ocurred while processing your command!",
@@ -366,24 +1121,41 @@ def get_action_activity(messages: list):
         }
     
 
-@app.activity_trigger(input_name="tab_context")
-def process_chat_context(tab_context: dict):
-    logging.info("Initializing chat message thread with tab context")
-
-    tab_id = tab_context.get("tabId")
-    html_content = tab_context.get("html")
-    screenshot_url = tab_context.get("screenshot")
-    chat_thread_id = str(uuid.uuid4())
-
+@app.activity_trigger(input_name="html")
+def condense_html_activity(html: str):
+    logging.info("Condensing tab html for chat thread context")
+    try:
+        html_digest = condense_html(html)
+    except Exception as e:
+        logging.error("Error condensing tab html: %s", e)
+        return {
+            "status": "error",
+            "html_digest": None,
+            "error": str(e)
+        }
+    logging.info("Condensed tab html from %d to %d chars", len(html or ''), len(html_digest))
+    return {
+        "status": "success",
+        "html_digest": html_digest,
+        "error": None
+    }
 
-    # TODO: Condense the HTML content and extract relevant information
 
-    # TODO: Compress screenshot if necessary
-    
+@app.activity_trigger(input_name="screenshot_url")
+def compress_screenshot_activity(screenshot_url: str):
+    logging.info("Compressing and storing tab screenshot for chat thread context")
+    try:
+        screenshot_ref = store_screenshot(screenshot_url)
+    except Exception as e:
+        logging.error("Error storing tab screenshot: %s", e)
+        return {
+            "status": "error",
+            "screenshot_ref": None,
+            "error": str(e)
+        }
+    logging.info("Stored tab screenshot of %d chars as a %d char reference", len(screenshot_url or ''), len(screenshot_ref or ''))
     return {
         "status": "success",
-        "chatThreadId": chat_thread_id,
-        "content": html_content,
-        "screenshot": screenshot_url,
+        "screenshot_ref": screenshot_ref,
         "error": None
-    }
\ No newline at end of file
+    }
@@ -1,5 +1,7 @@
 from dataclasses import dataclass
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Tuple
+
+__all__ = ["ToolParameter", "ToolDefinition", "EXTENSION_TOOLS", "get_tool_definitions"]
 
 
 @dataclass
@@ -51,7 +53,7 @@ class ToolDefinition:
             }
         }
 
-EXTENSION_TOOLS = [
+EXTENSION_TOOLS = (
     ToolDefinition(
         name="web_search",
         description="Search the web for information on any user question or query.",
@@ -167,13 +169,17 @@ EXTENSION_TOOLS = [
             ToolParameter(name="url", type="string", description="The URL to navigate to.", required=True),
         ]
     )
-]
+)
+
+# Tool definitions are static, so they are converted to the OpenAI format once at import
+_TOOL_DEFINITIONS_CACHE = tuple(tool.to_openai_format() for tool in EXTENSION_TOOLS)
 
-def get_tool_definitions() -> List[Dict[str, Any]]:
+def get_tool_definitions() -> Tuple[Dict[str, Any], ...]:
     """
     Get OpenAI function tool definitions for all available browser tools.
+    The definitions are shared and must not be mutated.
     
     Returns:
-        List[Dict[str, Any]]: List of tool definitions compatible with OpenAI API
+        Tuple[Dict[str, Any], ...]: Tool definitions compatible with OpenAI API
     """
-    return [tool.to_openai_format() for tool in EXTENSION_TOOLS]
+    return _TOOL_DEFINITIONS_CACHE
@@ -1,6 +1,30 @@
 import{ AgentAction, TabContext } from '../models/types';
 
 const BACKEND_URL = "http://localhost:7071/api/orchestrators"
+// Each status request waits up to ~2s server side, so this caps the wait at about a minute
+const MAX_STATUS_POLLS = 30;
+
+/**
+ * Orchestrator requests are accepted with a 202 response carrying the orchestration
+ * instance ID. Polls the status endpoint until the orchestration completes.
+ *
+ * @param response The response of the orchestrator start request.
+ * @returns Promise that resolves with the orchestration output.
+ */
+async function waitForOrchestration(response: Response): Promise<any> {
+    for (let polls = 0; response.status === 202; polls++) {
+        if (polls >= MAX_STATUS_POLLS) {
+            throw new Error('Timed out waiting for orchestration to complete');
+        }
+        const { id } = await response.json();
+        response = await fetch(`${BACKEND_URL}/status/${id}`);
+    }
+    if (!response.ok) {
+        throw new Error(`Error: ${response.status}, ${response.statusText}`);
+    }
+    return response.json();
+}
+
 /**
  * Upon a tab becoming active, this function uploads the tab context to a serverless 
  * function. Context is fed to a LLM to provide background for upcoming user prompts.
@@ -23,7 +47,7 @@ async function uploadContext(tabContext: TabContext): Promise<string> {
         if (!response.ok) {
             throw new Error(`Error: ${response.status}, ${response.statusText}`);
         }
-        const data = await response.json();
+        const data = await waitForOrchestration(response);
         console.log('Context uploaded successfully:', data);
         return data.chatThreadId;
     } catch (error) {
@@ -50,7 +74,7 @@ async function uploadUserPrompt(userPrompt: string, chatThreadId: string): Promi
         if (!response.ok) {
             throw new Error(`Error: ${response.status}, ${response.statusText}`);
         }
-        const data = await response.json();
+        const data = await waitForOrchestration(response);
         if (data.error) {
             throw new Error(`Error: ${data.error}`);
         }
@@ -75,7 +99,8 @@ async function uploadUserPrompt(userPrompt: string, chatThreadId: string): Promi
                 throw new Error('No actions received in tool_calls response');
             }
         }
-        return {type: "play_audio", audio: data["chat_audio"]} as AgentAction;
+        // The backend returns a short-lived blob URL when it can sign one, otherwise inline base64 audio
+        return {type: "play_audio", audio: data["chat_audio"] ?? null, audioUrl: data["chat_audio_url"] ?? null} as AgentAction;
     } catch (error) {
         throw new Error(`Failed to upload user prompt: ${error}`);
     }
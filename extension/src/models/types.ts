@@ -87,6 +87,6 @@ type AgentAction =
     | {type: "refresh_page"; tabIndex: number}
     | {type: "zoom"; level: number}
     | {type: "go_to_url"; url: string}
-    | {type: "play_audio"; audio: string | Blob};
+    | {type: "play_audio"; audio: string | Blob | null; audioUrl: string | null}; // inline base64 audio, or a short-lived URL to it
     
 export { TabContext, AgentAction, AgentActionType, UserPrompt, ChromeRuntimeMessage };
\ No newline at end of file